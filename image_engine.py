@@ -4,16 +4,32 @@ import cv2
 import sys
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+# Figures are only saved to files, no GUI backend is needed.
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 from PIL import Image, ImageOps, ImageDraw, ImageFont
-from scipy.ndimage import label, binary_closing, find_objects, center_of_mass
+
+# CuPy is optional, only needed when running on GPU.
+try:
+    import cupy as cp
+    import cupyx.scipy.ndimage as cpx
+except ImportError:
+    cp = None
 
 # Since we are dealing with big pictures :)
 Image.MAX_IMAGE_PIXELS = None
 
+# Font for star labels, loaded only once.
+try:
+    _FONT = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 60)
+except IOError:
+    _FONT = ImageFont.load_default()
+
 
-def crop_to_tiles(debug: bool, image_path: Path, tile_size: int) -> None:
+def crop_to_tiles(debug: bool, image_path: Path, tile_size: int) -> tuple:
     '''
     Function to crop an image into smaller 
     tiles of a given size.
@@ -22,7 +38,7 @@ def crop_to_tiles(debug: bool, image_path: Path, tile_size: int) -> None:
         image: Path to the image to open.
         tile_size: Desired size of the tiles.
     @Return:
-        None.
+        Minimum and maximum pixel value of the resized image.
     '''
     try:
         with Image.open(image_path.with_suffix(".tif")) as img:
@@ -40,20 +56,21 @@ def crop_to_tiles(debug: bool, image_path: Path, tile_size: int) -> None:
             tile_folder = image_path.parent / image_path
             tile_folder.mkdir(parents=True, exist_ok=True)
 
-            # Crop the image into tiles.
-            for i in range(x_tiles):
-                for j in range(y_tiles):
+            # Crop the image into tiles, a (y_tiles, x_tiles, tile_size, tile_size) block view of the pixels.
+            arr = np.asarray(img_resized)
+            # Only the array is needed, the image is held once while the tiles are written.
+            del img_resized
+            blocks = arr.reshape(y_tiles, tile_size, x_tiles, tile_size, *arr.shape[2:]).swapaxes(1, 2)
 
-                    # Define the box for each tile.
-                    left = i * tile_size
-                    upper = j * tile_size
-                    right = left + tile_size
-                    lower = upper + tile_size
+            def save_tile(i: int, j: int) -> None:
+                Image.fromarray(blocks[j, i]).save(tile_folder / f"tile_{i}_{j}.tif")
 
-                    # Crop the tile and save it.
-                    tile = img_resized.crop((left, upper, right, lower))
-                    tile_filename = f"tile_{i}_{j}.tif"
-                    tile.save(tile_folder / tile_filename)
+            # Save the tiles concurrently, writing is I/O bound.
+            with ThreadPoolExecutor() as executor:
+                futures = [executor.submit(save_tile, i, j) for i in range(x_tiles) for j in range(y_tiles)]
+                for future in futures:
+                    future.result()
+            return arr.min(), arr.max()
     except FileNotFoundError:
         print(f'ERROR: File {image_path} not found. Quitting!')
         sys.exit()
@@ -61,12 +78,30 @@ def crop_to_tiles(debug: bool, image_path: Path, tile_size: int) -> None:
         if debug:
             print(f'DEBUG: Cropped {image_path} into tiles!')
 
-def normalize_image(image_path: Path) -> np.array:
+def build_normalization_lut(lo: int, hi: int) -> np.array:
+    '''
+    Builds a lookup table mapping 16-bit (or 8-bit) pixel values
+    in the range [lo, hi] onto [0, 255].
+    @Args:
+        lo: Pixel value mapped to 0.
+        hi: Pixel value mapped to 255.
+    @Return:
+        Lookup table with 65536 uint8 entries.
+    '''
+    if hi <= lo:
+        return np.zeros(65536, dtype=np.uint8)
+    # Same formula as the per-pixel normalization, the table is small enough for float64.
+    lut = (np.arange(65536, dtype=np.float64) - float(lo)) / (float(hi) - float(lo)) * 255
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+def normalize_image(image_path: Path, lut: np.array = None) -> np.array:
     '''
     Firstly converts the image into a numpy array
     and then normalizes it.
     @Args:
         image: Path to image to normalize.
+        lut: Lookup table from build_normalization_lut shared by all tiles of the source image.
+             If None, the tile is normalized by its own minimum and maximum. By default None.
     @Return:
         Normalized image.
     '''
@@ -76,21 +111,36 @@ def normalize_image(image_path: Path) -> np.array:
         print(f'ERROR: Image {image_path} not found. Quitting!')
         sys.exit()
     finally:
-        image = np.array(image)
-        image = (image - image.min()) / (image.max() - image.min()) * 255
-        return image.astype(np.uint8)  
+        image = np.asarray(image)
+        if lut is not None and image.dtype in (np.uint8, np.uint16):
+            return lut[image]
+
+        lo, hi = image.min(), image.max()
+
+        # Typical 8/16-bit TIFFs are mapped through a lookup table, no float image is created.
+        if image.dtype in (np.uint8, np.uint16):
+            return build_normalization_lut(lo=lo, hi=hi)[image]
+        out = np.empty_like(image, dtype=np.float32)
+        np.subtract(image, lo, out=out)
+        if hi > lo:
+            out /= np.float32(hi - lo)
+        out *= 255
+        return out.astype(np.uint8)
     
-def invert_image(image: np.array) -> np.array:
+def invert_image(image: np.array, in_place: bool = False) -> np.array:
     '''
     Inverts an image using numpy.
     @Args:
         image: Image to invert.
+        in_place: If True, the provided image is overwritten instead of copied. By default False.
     @Return:
         Returns an inverted image.
     '''
+    if in_place:
+        return np.invert(image, out=image)
     return np.invert(image)
 
-def find_brightest_spots(image: np.array, threshold: int, min_blob_size: int = 50, max_stars: int = 5) -> Image.Image | list:
+def find_brightest_spots(image: np.array, threshold: int, min_blob_size: int = 50, max_stars: int = 5, use_gpu: bool = False) -> Image.Image | list:
     '''
     Finds bright stars in the provided image and draws a circle around them. 
     Also returns their coordinates.
@@ -100,42 +150,41 @@ def find_brightest_spots(image: np.array, threshold: int, min_blob_size: int = 5
         min_blob_size: Minimum size of a blob to be considered a star. By default 50.
         use_adaptive_threshold: If True, use adaptive Otsu's method if no threshold is provided. By default True.
         max_stars: Maximum number of stars to detect. By default 5.      
+        use_gpu: If True, the mask, labeling and centroids are computed on GPU using CuPy. By default False.
     @Return:
         PIL Image with circles drawn at star locations, and a list of star center coordinates.
         List of the brightest stars coordinates.
     '''
-    # Create binary mask for bright pixels.
-    binary_mask = image >= threshold
-    binary_mask = binary_closing(binary_mask, structure=np.ones((3, 3)))
-    
-    # Label connected components
-    labeled_array, num_features = label(binary_mask)
-    
-    # Filter out small blobs 
-    object_slices = find_objects(labeled_array)
-    for i, obj_slice in enumerate(object_slices, start=1):
-        region_size = np.sum(labeled_array[obj_slice] == i)
-        if region_size < min_blob_size:  # Remove small blobs
-            labeled_array[labeled_array == i] = 0
-    labeled_array, num_features = label(labeled_array > 0)
-    
-    # Calculate centroids of connected components
-    centroids = center_of_mass(binary_mask, labeled_array, range(1, num_features + 1))
+    if use_gpu:
+        centroids = _find_centroids_gpu(image=image, threshold=threshold, min_blob_size=min_blob_size)
+    else:
+        # Create binary mask for bright pixels.
+        binary_mask = (image >= threshold).astype(np.uint8)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel)
+        
+        # Label connected components, their areas and centroids in one pass.
+        _, _, stats, cv_centroids = cv2.connectedComponentsWithStats(binary_mask, connectivity=4, ltype=cv2.CV_32S)
+        
+        # Filter out small blobs, skipping the background, and swap (x, y) to (y, x).
+        keep_mask = stats[1:, cv2.CC_STAT_AREA] >= min_blob_size
+        centroids = cv_centroids[1:][keep_mask][:, ::-1]
     
     # Filter out only the brightest stars
     if len(centroids) > max_stars:
-        # Sort centroids by image brightness at centroid positions and keep the top `max_stars`
-        centroids = sorted(centroids, key=lambda c: image[int(c[0]), int(c[1])], reverse=True)[:max_stars]
+        # Rank centroids by image brightness at centroid positions and keep the top `max_stars`
+        cents = np.asarray(centroids)
+        brightness = image[cents[:, 0].astype(np.intp), cents[:, 1].astype(np.intp)]
+        # Stable sort keeps tied (e.g. saturated) stars in label order, as sorted() did.
+        idx = np.argsort(-brightness.astype(np.int32), kind='stable')[:max_stars]
+        centroids = cents[idx]
     
     # Draw circles on the image at the positions of star centers
     output_image = Image.fromarray(np.uint8(image))
     output_image = output_image.convert("RGB")
     draw = ImageDraw.Draw(output_image)
 
-    try:
-        font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 60)        
-    except IOError:
-        font = ImageFont.load_default()
+    font = _FONT
     
     star_coordinates = []
     for index, (y, x) in enumerate(centroids):  
@@ -152,6 +201,109 @@ def find_brightest_spots(image: np.array, threshold: int, min_blob_size: int = 5
     
     return output_image, star_coordinates
 
+def _find_centroids_gpu(image: np.array, threshold: int, min_blob_size: int) -> np.array:
+    '''
+    GPU counterpart of the mask, labeling and centroid steps
+    of find_brightest_spots. The centroids are computed on device
+    and copied back to host in a single transfer.
+    @Args:
+        image: Image to find stars in.
+        threshold: Minimal brightness to identify a star.
+        min_blob_size: Minimum size of a blob to be considered a star.
+    @Return:
+        Array of (y, x) centroids of the remaining blobs.
+    '''
+    if cp is None:
+        print(f'ERROR: CuPy is not installed, unable to use GPU. Quitting!')
+        sys.exit()
+
+    # Create binary mask for bright pixels.
+    image_gpu = cp.asarray(image)
+    binary_mask = image_gpu >= threshold
+    # Closing as dilation + erosion with a border of ones, like cv2.MORPH_CLOSE on CPU,
+    # so blobs touching the tile edge are not eroded.
+    structure = cp.ones((3, 3), dtype=bool)
+    binary_mask = cpx.binary_dilation(binary_mask, structure=structure, border_value=0)
+    binary_mask = cpx.binary_erosion(binary_mask, structure=structure, border_value=1)
+
+    # Label connected components, only the foreground pixels are needed further.
+    labeled_array, _ = cpx.label(binary_mask)
+    ys, xs = cp.nonzero(labeled_array)
+    labels = labeled_array[ys, xs]
+
+    # Blob sizes and coordinate sums per label, keep only big enough blobs.
+    sizes = cp.bincount(labels, minlength=1)
+    sum_y = cp.bincount(labels, weights=ys, minlength=1)
+    sum_x = cp.bincount(labels, weights=xs, minlength=1)
+    keep_mask = sizes >= min_blob_size
+    keep_mask[0] = False
+
+    # Calculate centroids of connected components.
+    centroids = cp.stack((sum_y[keep_mask] / sizes[keep_mask], sum_x[keep_mask] / sizes[keep_mask]), axis=-1)
+    return cp.asnumpy(centroids)
+
+def _display_data(image: np.array, max_pool: bool = False) -> np.array:
+    '''
+    Prepares an image for plotting, i.e. downsamples it
+    to at most 1024 pixels per side using a strided view.
+    @Args:
+        image: Image (or PIL image) to display.
+        max_pool: If True, each output pixel is the maximum of its block instead,
+                  so narrow bright spots are kept. By default False.
+    @Return:
+        Downsampled image.
+    '''
+    image = np.asarray(image)
+    if image.dtype == bool:
+        image = image.astype(np.uint8)
+    step = max(1, int(np.ceil(max(image.shape[:2]) / 1024)))
+    if not max_pool or step == 1:
+        return image[::step, ::step]
+
+    # Pad to a multiple of the step and take the maximum of every step x step block.
+    height, width = image.shape[:2]
+    pad_h, pad_w = -height % step, -width % step
+    padded = np.pad(image, ((0, pad_h), (0, pad_w)), constant_values=image.min())
+    return padded.reshape((height + pad_h) // step, step, (width + pad_w) // step, step).max(axis=(1, 3))
+
+def _update_image(axes_image, image: np.array, max_pool: bool = False) -> None:
+    '''
+    Replaces the data of a cached imshow and rescales its colors.
+    @Args:
+        axes_image: AxesImage returned by imshow.
+        image: New image to show.
+        max_pool: Passed to _display_data. By default False.
+    @Return:
+        None
+    '''
+    data = _display_data(image, max_pool=max_pool)
+    axes_image.set_data(data)
+    axes_image.set_extent((-0.5, data.shape[1] - 0.5, data.shape[0] - 0.5, -0.5))
+    axes_image.autoscale()
+
+# Figures reused across tiles, created on first use.
+_TRSF_FIG = None
+_DIFF_FIG = None
+
+def _get_trsf_fig() -> tuple:
+    '''
+    Creates the transformation figure once and returns it.
+    @Return:
+        Figure and list of its four AxesImages.
+    '''
+    global _TRSF_FIG
+    if _TRSF_FIG is None:
+        fig, axes = plt.subplots(2, 2, figsize=(10, 10))
+        titles = ["Past Image", "Recent Image", "Past Image aligned with Recent Image", "Footprint of the Transformation"]
+        images = []
+        for ax, title in zip(axes.flat, titles):
+            images.append(ax.imshow(np.zeros((1024, 1024), dtype=np.uint8), cmap='gray', interpolation='none'))
+            ax.axis('off')
+            ax.set_title(title)
+        fig.tight_layout()
+        _TRSF_FIG = fig, images
+    return _TRSF_FIG
+
 def prepare_fig(image1: np.array, image2: np.array, image3: np.array, image4:np.array, tile_name: str, save_path: Path) -> None:
     '''
     Funcion which saves the plot of four images. 
@@ -166,30 +318,13 @@ def prepare_fig(image1: np.array, image2: np.array, image3: np.array, image4:np.
     @Return:
         None
     '''
-    fig, axes = plt.subplots(2, 2, figsize=(10, 10))
-    axes[0, 0].imshow(np.flipud((image1)), cmap='gray', interpolation='none', origin='lower')
-    axes[0, 0].axis('off')
-    axes[0, 0].set_title("Past Image")
+    fig, images = _get_trsf_fig()
+    for axes_image, image in zip(images, (image1, image2, image3, image4)):
+        _update_image(axes_image, image)
 
-    axes[0, 1].imshow(np.flipud((image2)), cmap='gray', interpolation='none', origin='lower')
-    axes[0, 1].axis('off')
-    axes[0, 1].set_title("Recent Image")
-
-    axes[1, 0].imshow(np.flipud((image3)), cmap='gray', interpolation='none', origin='lower')
-    axes[1, 0].axis('off')
-    axes[1, 0].set_title("Past Image aligned with Recent Image")
-
-    axes[1, 1].imshow(np.flipud((image4)), cmap='gray', interpolation='none', origin='lower')
-    axes[1, 1].axis('off')
-    axes[1, 1].set_title("Footprint of the Transformation")
-
-    axes[1, 0].axis('off')
-
-    plt.tight_layout()
     fig_filename = f"{tile_name}_transformation.png"  # e.g. 'tile_0_0_transformation.png'.
     fig_path = save_path / fig_filename
-    plt.savefig(fig_path, bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(fig_path)
 
 def apply_non_local_means_denoising(image: np.array, h: int = 7) -> np.array:
     '''
@@ -203,7 +338,42 @@ def apply_non_local_means_denoising(image: np.array, h: int = 7) -> np.array:
     '''
     return cv2.fastNlMeansDenoising(image, None, h, 7, 21)
 
-def create_diff_map(image1: np.array, image2: np.array, image3: np.array, tile_name: str, save_path: Path) -> None:
+def _get_diff_fig() -> tuple:
+    '''
+    Creates the difference map figure once and returns it.
+    @Return:
+        Figure and list of its four AxesImages.
+    '''
+    global _DIFF_FIG
+    if _DIFF_FIG is None:
+        fig = plt.figure(figsize=(10, 10))
+        gs = GridSpec(2, 3, figure=fig, width_ratios=[1, 1, 0.05], height_ratios=[1, 1], wspace=0.1, hspace=0.2)
+        placeholder = np.zeros((1024, 1024), dtype=np.uint8)
+
+        # Plot norm_past, norm_recent and transformed_past.
+        titles = ["Inverted and Normalized Past Image", "Inverted and Normalized Recent Image", "Transformed Past Image"]
+        images = []
+        for position, title in zip((gs[0, 0], gs[0, 1], gs[1, 0]), titles):
+            ax = fig.add_subplot(position)
+            images.append(ax.imshow(placeholder, cmap='gray', interpolation='none'))
+            ax.axis('off')
+            ax.set_title(title)
+
+        # Plot difference map.
+        ax4 = fig.add_subplot(gs[1, 1])
+        img = ax4.imshow(placeholder, cmap='inferno', vmin=0, vmax=1)
+        ax4.axis('off')
+        ax4.set_title("Difference Map (Transformed Past - Recent)")
+        images.append(img)
+
+        # Colorbar placed in the 3rd column of the bottom row.
+        cbar_ax = fig.add_subplot(gs[1, 2])
+        cbar = fig.colorbar(img, cax=cbar_ax, orientation='vertical')
+        cbar.set_label('Difference Intensity', rotation=270, labelpad=15)
+        _DIFF_FIG = fig, images
+    return _DIFF_FIG
+
+def create_diff_map(image1: np.array, image2: np.array, image3: np.array, tile_name: str, save_path: Path) -> np.array:
     '''
     Function to create and save a difference map between two provided images.
     @Args:
@@ -213,47 +383,27 @@ def create_diff_map(image1: np.array, image2: np.array, image3: np.array, tile_n
         tile_name: Name of the tile. Used to file naming.
         save_path: Path where to save the file to.
     @Return:
-        None
+        The difference map.
     '''
-    difference_map = np.abs(image3 - image2)
-
-    fig = plt.figure(figsize=(10, 10))
-    gs = GridSpec(2, 3, figure=fig, width_ratios=[1, 1, 0.05], height_ratios=[1, 1], wspace=0.1, hspace=0.2)
-
-    # Plot norm_past.
-    ax1 = fig.add_subplot(gs[0, 0])
-    ax1.imshow(np.flipud(image1), cmap='gray', interpolation='none', origin='lower')
-    ax1.axis('off')
-    ax1.set_title("Inverted and Normalized Past Image")
-
-    # Plot norm_recent.
-    ax2 = fig.add_subplot(gs[0, 1])
-    ax2.imshow(np.flipud(image2), cmap='gray', interpolation='none', origin='lower')
-    ax2.axis('off')
-    ax2.set_title("Inverted and Normalized Recent Image")
-
-    # Plot transformed_past.
-    ax3 = fig.add_subplot(gs[1, 0])
-    ax3.imshow(np.flipud(image3), cmap='gray', interpolation='none', origin='lower')
-    ax3.axis('off')
-    ax3.set_title("Transformed Past Image")
-
-    # Plot difference map.
-    ax4 = fig.add_subplot(gs[1, 1])
-    img = ax4.imshow(np.flipud(difference_map), cmap='inferno', vmin=0, vmax=difference_map.max(), origin='lower')
-    ax4.axis('off')
-    ax4.set_title("Difference Map (Transformed Past - Recent)")
-
-    # Colorbar placed in the 3rd column of the bottom row.
-    cbar_ax = fig.add_subplot(gs[1, 2])
-    cbar = fig.colorbar(img, cax=cbar_ax, orientation='vertical')
-    cbar.set_label('Difference Intensity', rotation=270, labelpad=15)
+    # Round (and clip interpolation overshoot of) the transformed image instead of truncating it.
+    transformed = np.rint(image3)
+    np.clip(transformed, 0, 255, out=transformed)
+    difference_map = cv2.absdiff(transformed.astype(np.uint8), image2.astype(np.uint8, copy=False))
+    _, max_difference, _, _ = cv2.minMaxLoc(difference_map)
+
+    fig, images = _get_diff_fig()
+    for axes_image, image in zip(images[:3], (image1, image2, image3)):
+        _update_image(axes_image, image)
+
+    # Max-pool the difference map, so narrow lost star candidates stay visible.
+    _update_image(images[3], difference_map, max_pool=True)
+    images[3].set_clim(0, max_difference)
 
     # Save the plot.
     fig_filename = f"{tile_name}_transformation.png"  # e.g. 'tile_0_0_transformation.png'.
     fig_path = save_path / fig_filename
-    plt.savefig(fig_path, bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(fig_path)
+    return difference_map
 
 def create_avg_diff_map(avg_diff_map: np.array, save_path: Path, tile_idx: int) -> None:
     '''
@@ -269,7 +419,7 @@ def create_avg_diff_map(avg_diff_map: np.array, save_path: Path, tile_idx: int)
     fig, ax = plt.subplots(figsize=(8, 8))
 
      # Plot the difference map
-    img = ax.imshow(np.flipud(avg_diff_map), cmap='inferno', origin='lower')
+    img = ax.imshow(avg_diff_map, cmap='inferno')
     ax.axis('off')  # Turn off the axes for a cleaner plot
     ax.set_title(f"Average Difference Map", fontsize=16)
 
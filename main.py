@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
+import os
 import sys
 import yaml
 import argparse
 import astroalign as aa
 from pathlib import Path
-
-# To prevent certain issues I encountered.
-import matplotlib
-matplotlib.use('tkagg')
+from itertools import repeat
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from image_engine import *
 from utils import *
 
 DEBUG = False
+USE_GPU = False
 PAST_IMAGES_PATH = None
 RECENT_IMAGES_PATH = None
 TRSF_PATH = None
 DIFF_MAP_PATH = None
+TILE_SIZE = 2048
+# Every worker creates its own CUDA context, so keep few of them in GPU mode.
+GPU_WORKERS = 2
 
 def resolve_args(args) -> None:
     '''
@@ -24,14 +28,14 @@ def resolve_args(args) -> None:
     The following is currently required:
     i) source_folder with past images
     ii) source folder with recent images
-    Debug mode is disabled by default.
+    Debug mode and GPU mode are disabled by default.
     If no args are given, quit.
     @Args:
         args: Console args given by the user.
     @Return:
         None.
     '''
-    global DEBUG, PAST_IMAGES_PATH, RECENT_IMAGES_PATH, TRSF_PATH, DIFF_MAP_PATH
+    global DEBUG, USE_GPU, PAST_IMAGES_PATH, RECENT_IMAGES_PATH, TRSF_PATH, DIFF_MAP_PATH
     if len(sys.argv) <= 1:
         print(f'WARN: No arguments were provided. Quitting!')
         sys.exit()
@@ -39,6 +43,9 @@ def resolve_args(args) -> None:
         if args.debug:
             DEBUG = True
             print(f'DEBUG: Debug mode enabled!')
+        if args.gpu:
+            USE_GPU = True
+            print(f'INFO: GPU mode enabled!')
         if not(args.source_folder_past):
             print(f'WARN: No source folder for past images provided. Quitting')
             sys.exit()
@@ -70,6 +77,102 @@ def resolve_args(args) -> None:
             print(f'DEBUG: Args parsed!')
         print(f'INFO: Initialization complete!')
 
+def process_tile_pair(args: tuple) -> np.array:
+    '''
+    Processes a single pair of tiles, i.e. finds the stars,
+    determines the transformation and saves the plots.
+    Runs within a worker process of the pool.
+    @Args:
+        args: Tuple of (past_tile_path, recent_tile_path, past_lut, recent_lut, pair_folder_path, diff_map_path, debug, use_gpu).
+    @Return:
+        Difference map of the transformed past tile and the recent tile.
+    '''
+    past_tile_path, recent_tile_path, past_lut, recent_lut, pair_folder_path, diff_map_path, debug, use_gpu = args
+
+    norm_past = invert_image(image=normalize_image(image_path=past_tile_path, lut=past_lut), in_place=True)
+    norm_recent = invert_image(image=normalize_image(image_path=recent_tile_path, lut=recent_lut), in_place=True)
+    if debug:
+        print(f'DEBUG: Images {norm_past} and {norm_recent} inverted!')
+    
+    #Past spots and recent spots are images with circles drawn around stars
+    past_spots, past_cords = find_brightest_spots((norm_past), 200, use_gpu=use_gpu)
+    recent_spots, recent_cords = find_brightest_spots((norm_recent), 200, use_gpu=use_gpu)
+
+    src_cords, trgt_cords = sort_corresponding_stars(debug=debug, array1=past_cords, array2=recent_cords)
+    if debug:
+        print(f'DEBUG: Stars coordinates sorted!')
+    try:    
+        tform = aa.estimate_transform('affine', src_cords, trgt_cords)
+        if debug:
+            print(f'DEBUG: Transformation found!')
+    except aa.MaxIterError:
+        print(f'ERROR: Transformation not found!')
+    try:
+        transformed_past, footprint = aa.apply_transform(tform, norm_past, norm_recent)
+        if debug:
+            print(f'DEBUG: Transformation applied!')
+    except np.linalg.LinAlgError:
+        print(f'ERROR: Unable to apply transformation!')
+        
+    # Make plots.
+    print(f'INFO: Preparing plots!')
+    tile_name = Path(past_tile_path).stem  
+    prepare_fig(image1=past_spots, image2=recent_spots, image3=transformed_past, image4=footprint, tile_name=tile_name,save_path=pair_folder_path)      
+    return create_diff_map(image1=norm_past, image2=norm_recent, image3=transformed_past, tile_name=tile_name, save_path=diff_map_path)
+
+def crop_once(image_path: Path, cropped: dict) -> tuple:
+    '''
+    Crops an image into tiles unless it was already cropped during this run.
+    Images shared by several pairs are thus never rewritten while
+    their tiles may be read by the pool.
+    @Args:
+        image_path: Path to the image to crop.
+        cropped: Image path -> (min, max) of the images cropped so far.
+    @Return:
+        Minimum and maximum pixel value of the resized image.
+    '''
+    if image_path not in cropped:
+        cropped[image_path] = crop_to_tiles(debug=DEBUG, image_path=image_path, tile_size=TILE_SIZE)
+    elif DEBUG:
+        print(f'DEBUG: {image_path} already cropped, reusing its tiles!')
+    return cropped[image_path]
+
+def prepare_pair(pair: dict, cropped: dict) -> list:
+    '''
+    Crops both images of a pair into tiles and creates
+    the output folders. Runs in the background while the
+    previous pair is being processed.
+    @Args:
+        pair: Image pair from the config file.
+        cropped: Image path -> (min, max) of the images cropped so far, see crop_once.
+    @Return:
+        List of tasks for process_tile_pair, one per tile pair.
+    '''
+    past, recent = pair['past_image'], pair['recent_image']
+    
+    past_lo, past_hi = crop_once(image_path=Path.joinpath(PAST_IMAGES_PATH, past), cropped=cropped)
+    recent_lo, recent_hi = crop_once(image_path=Path.joinpath(RECENT_IMAGES_PATH, recent), cropped=cropped)
+    print(f'INFO: Cropped!')
+
+    # Normalize all tiles of an image by the same range, avoiding brightness jumps between tiles.
+    past_lut = build_normalization_lut(lo=past_lo, hi=past_hi)
+    recent_lut = build_normalization_lut(lo=recent_lo, hi=recent_hi)
+    
+    # Load paths to tiles.
+    past_tiles = load_tiles_from_folder(debug=DEBUG, folder_path=Path.joinpath(PAST_IMAGES_PATH, past))
+    recent_tiles = load_tiles_from_folder(debug=DEBUG, folder_path=Path.joinpath(RECENT_IMAGES_PATH, recent))
+
+    # Create subfolders.
+    image_pair_folder_name = f"{Path(past).stem}_vs_{Path(recent).stem}"  # e.g. 602940_vs_603172.
+    pair_folder_path = TRSF_PATH / image_pair_folder_name
+    pair_folder_path.mkdir(parents=True, exist_ok=True)  
+    diff_map_path = DIFF_MAP_PATH / image_pair_folder_name
+    diff_map_path.mkdir(parents=True, exist_ok=True)
+    if DEBUG:
+        print(f'DEBUG: Folders for each pair transformation and difference map created successfully!')
+
+    return list(zip(past_tiles, recent_tiles, repeat(past_lut), repeat(recent_lut), repeat(pair_folder_path), repeat(diff_map_path), repeat(DEBUG), repeat(USE_GPU)))
+
 def main() -> None:
     print(f'INFO: Starting main!')
     try:
@@ -86,67 +189,29 @@ def main() -> None:
     # Store all difference maps.
     tile_diff_maps = {}
 
-    for i, pair in enumerate(image_pairs, start=1):
-        print(f"INFO: Processing pair {i}...")
-        past, recent = pair['past_image'], pair['recent_image']
-        
-        crop_to_tiles(debug=DEBUG, image_path=Path.joinpath(PAST_IMAGES_PATH, past), tile_size=2048)
-        crop_to_tiles(debug=DEBUG, image_path=Path.joinpath(RECENT_IMAGES_PATH, recent), tile_size=2048)
-        print(f'INFO: Cropped!')
-        
-        # Load paths to tiles.
-        past_tiles = load_tiles_from_folder(debug=DEBUG, folder_path=Path.joinpath(PAST_IMAGES_PATH, past))
-        recent_tiles = load_tiles_from_folder(debug=DEBUG, folder_path=Path.joinpath(RECENT_IMAGES_PATH, recent))
-
-        # Create subfolders.
-        image_pair_folder_name = f"{Path(past).stem}_vs_{Path(recent).stem}"  # e.g. 602940_vs_603172.
-        pair_folder_path = TRSF_PATH / image_pair_folder_name
-        pair_folder_path.mkdir(parents=True, exist_ok=True)  
-        diff_map_path = DIFF_MAP_PATH / image_pair_folder_name
-        diff_map_path.mkdir(parents=True, exist_ok=True)
-        if DEBUG:
-            print(f'DEBUG: Folders for each pair transformation and difference map created successfully!')
-
-        print(f'INFO: Determining transformations!')
-        for tile_idx, (past_tile_path, recent_tile_path) in enumerate(zip(past_tiles, recent_tiles)):
-            norm_past = invert_image(image=normalize_image(image_path=past_tile_path))
-            norm_recent = invert_image(image=normalize_image(image_path=recent_tile_path))
-            if DEBUG:
-                print(f'DEBUG: Images {norm_past} and {norm_recent} inverted!')
-            
-            #Past spots and recent spots are images with circles drawn around stars
-            past_spots, past_cords = find_brightest_spots((norm_past), 200)
-            recent_spots, recent_cords = find_brightest_spots((norm_recent), 200)
-
-            src_cords, trgt_cords = sort_corresponding_stars(debug=DEBUG, array1=past_cords, array2=recent_cords)
-            if DEBUG:
-                print(f'DEBUG: Stars coordinates sorted!')
-            try:    
-                tform = aa.estimate_transform('affine', src_cords, trgt_cords)
-                if DEBUG:
-                    print(f'DEBUG: Transformation found!')
-            except aa.MaxIterError:
-                print(f'ERROR: Transformation not found!')
-            try:
-                transformed_past, footprint = aa.apply_transform(tform, norm_past, norm_recent)
-                if DEBUG:
-                    print(f'DEBUG: Transformation applied!')
-            except np.linalg.LinAlgError:
-                print(f'ERROR: Unable to apply transformation!')
-                
-            # Make plots.
-            print(f'INFO: Preparing plots!')
-            tile_name = Path(past_tile_path).stem  
-            prepare_fig(image1=past_spots, image2=recent_spots, image3=transformed_past, image4=footprint, tile_name=tile_name,save_path=pair_folder_path)      
-            create_diff_map(image1=norm_past, image2=norm_recent, image3=transformed_past, tile_name=tile_name, save_path=diff_map_path) 
-
-            # Store the difference map for the current tile index
-            diff_map = np.abs(transformed_past - norm_recent)
-            if tile_idx not in tile_diff_maps:
-                tile_diff_maps[tile_idx] = []
-                if DEBUG:
-                    print(f'DEBUG: Difference map for {tile_idx} added!')
-            tile_diff_maps[tile_idx].append(diff_map)
+    # Tiles are processed by the pool, while the next pair is cropped in the background.
+    # Each image is cropped only once, see crop_once.
+    cropped = {}
+    workers = GPU_WORKERS if USE_GPU else os.cpu_count()
+    with Pool(workers) as pool, ThreadPoolExecutor(max_workers=1) as io_pool:
+        next_tasks = io_pool.submit(prepare_pair, image_pairs[0], cropped) if image_pairs else None
+        for i in range(1, len(image_pairs) + 1):
+            print(f"INFO: Processing pair {i}...")
+            tasks = next_tasks.result()
+
+            print(f'INFO: Determining transformations!')
+            result = pool.map_async(process_tile_pair, tasks)
+            if i < len(image_pairs):
+                next_tasks = io_pool.submit(prepare_pair, image_pairs[i], cropped)
+            diff_maps = result.get()
+
+            # Store the difference map for each tile index.
+            for tile_idx, diff_map in enumerate(diff_maps):
+                if tile_idx not in tile_diff_maps:
+                    tile_diff_maps[tile_idx] = []
+                    if DEBUG:
+                        print(f'DEBUG: Difference map for {tile_idx} added!')
+                tile_diff_maps[tile_idx].append(diff_map)
     
     # Compute and save the average difference map for each tile
     print(f'INFO: Computing average difference maps for each tile!')
@@ -165,6 +230,7 @@ def main() -> None:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Lost Stars')
     parser.add_argument('-d', '--debug', action='store_true', dest='debug')
+    parser.add_argument('-g', '--gpu', action='store_true', dest='gpu')
     parser.add_argument('-p', '--source_folder_past',dest='source_folder_past')
     parser.add_argument('-r', '--source_folder_recent', dest ='source_folder_recent')
     args = parser.parse_args()
@@ -5,6 +5,7 @@ import sys
 import numpy as np
 from glob import glob
 from pathlib import Path
+from scipy.optimize import linear_sum_assignment
 
 def print_folder_content(debug: bool, source_path: Path) -> None: 
     '''
@@ -22,6 +23,17 @@ def print_folder_content(debug: bool, source_path: Path) -> None:
         if entry.is_file():
             print(f'INFO: Found the following file: {entry}!')
 
+def _count_files(path: Path) -> int:
+    '''
+    Counts the files in the given folder using a single scandir pass.
+    @Args:
+        path: Path to the folder.
+    @Return:
+        Number of files within the folder.
+    '''
+    with os.scandir(path) as it:
+        return sum(1 for entry in it if entry.is_file())
+
 def check_folder_content(debug: bool, path1: Path, path2: Path) -> None:
     '''
     Helper function to make sure that
@@ -38,7 +50,7 @@ def check_folder_content(debug: bool, path1: Path, path2: Path) -> None:
     if not(path1.exists()) or not(path2.exists()):
         print(f'WARN: Directory does not exist. Quitting!')
         sys.exit()
-    if (sum(1 for x in path1.glob('*') if x.is_file())) != (sum(1 for x in path2.glob('*') if x.is_file())):
+    if _count_files(path1) != _count_files(path2):
         print(f'WARN: Mismatch in number of files in {path1} and {path2}. Quitting!')
         sys.exit()
     if debug:
@@ -74,9 +86,20 @@ def load_tiles_from_folder(debug: bool, folder_path: Path) -> list:
         print(f"DEBUG: Found {len(tile_paths)} tiles in {folder_path}!")
     return tile_paths
 
+def _pair_dist(a1: np.array, a2: np.array) -> np.array:
+    '''
+    Computes the euclidean distances between all pairs of points.
+    @Args:
+        a1: Array of shape (N, 2).
+        a2: Array of shape (M, 2).
+    @Returns:
+        Distance matrix of shape (N, M).
+    '''
+    return np.linalg.norm(a1[:, None] - a2[None, :], axis=-1)
+
 def sort_corresponding_stars(debug: bool, array1: list, array2: list, num_matches: int = 3) -> np.array:
     '''
-    Matches points (stars coordinates) from two arrays based on minimal distances, keeping the closest matches.
+    Matches points (stars coordinates) from two arrays one-to-one based on minimal distances, keeping the closest matches.
     Only the 'num_matches' closest points (in terms of minimal distance) are kept.
     @Args:
         debug: Debug flag.
@@ -90,22 +113,20 @@ def sort_corresponding_stars(debug: bool, array1: list, array2: list, num_matche
     # Calculate distances between all pairs (i from array1, j from array2).
     if debug:
         print(f'DEBUG: Calculating distances!')
-    distances = []
-    for i, p1 in enumerate(array1):
-        for j, p2 in enumerate(array2):
-            dist = np.linalg.norm(np.array(p1) - np.array(p2))
-            distances.append((dist, i, j))  #[(distance, index_in_array1, index_in_array2), ...].
-    
-    # Sort distances by the smallest distance first.
-    distances.sort(key=lambda x: x[0])
+    array1 = np.asarray(array1).reshape(-1, 2)
+    array2 = np.asarray(array2).reshape(-1, 2)
+    distances = _pair_dist(array1, array2)
+
+    # Find the one-to-one assignment minimizing the total distance.
+    rows, cols = linear_sum_assignment(distances)
 
     # Keep only the best closest matches.
-    best_matches = distances[:num_matches]
+    best_matches = np.argsort(distances[rows, cols])[:num_matches]
 
     # Reconstruct the matched arrays based on the best matches
-    reordered_array1 = [array1[i] for _, i, _ in best_matches]
-    reordered_array2 = [array2[j] for _, _, j in best_matches]
+    reordered_array1 = array1[rows[best_matches]]
+    reordered_array2 = array2[cols[best_matches]]
     if debug:
         print(f'DEBUG: Arrays sorted!')
 
-    return np.array(reordered_array1), np.array(reordered_array2)
+    return reordered_array1, reordered_array2